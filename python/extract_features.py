@@ -7,9 +7,12 @@
 #   A function named extract_from_video(video_path) -> dict with keys:
 #     blink_rate_bpm, incomplete_blink_ratio, avg_ibi_sec, redness_index
 
-import sys, cv2, math, csv, re, numpy as np
+import os, sys, cv2, csv, re, math, threading, numpy as np
 import mediapipe as mp
+from array import array
 from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 
 mp_face = mp.solutions.face_mesh
 
@@ -19,121 +22,202 @@ R_EYE_RING = [263, 249, 390, 373, 374, 380, 381, 382, 362, 398, 384, 385, 386, 3
 L_IRIS = [469, 470, 471, 472]
 R_IRIS = [474, 475, 476, 477]
 
-def dist(a, b): 
-    return math.dist(a, b)
-
-def ear(landmarks, w, h, left=True):
-    """6-point Eye Aspect Ratio (EAR)."""
-    idx = [33,160,158,133,153,144] if left else [263,387,385,362,380,373]
-    pts = [(landmarks[i].x * w, landmarks[i].y * h) for i in idx]
-    p1,p2,p3,p4,p5,p6 = pts
-    return (dist(p2,p6) + dist(p3,p5)) / (2.0 * dist(p1,p4) + 1e-6)
-
-def poly_mask(h, w, pts):
-    mask = np.zeros((h, w), dtype=np.uint8)
-    cv2.fillPoly(mask, [np.array(pts, dtype=np.int32)], 255)
-    return mask
-
-def circle_from_pts(pts):
-    """Crude circle from 4 iris points: center=mean, radius=mean distance."""
-    cx = np.mean([p[0] for p in pts]); cy = np.mean([p[1] for p in pts])
-    r  = np.mean([math.hypot(p[0]-cx, p[1]-cy) for p in pts])
-    return (int(cx), int(cy), int(max(r, 1)))
-
-def redness_index(frame, landmarks):
-    """Approx sclera redness: mean R/(R+G+B) over (eye ring - iris) on bright pixels."""
+# Same indices as NumPy arrays, built once for fancy-indexing the landmark array
+L_EYE_RING_IDX = np.asarray(L_EYE_RING, dtype=np.intp)
+R_EYE_RING_IDX = np.asarray(R_EYE_RING, dtype=np.intp)
+EYE_RINGS_IDX = np.concatenate([L_EYE_RING_IDX, R_EYE_RING_IDX])
+L_IRIS_IDX = np.asarray(L_IRIS, dtype=np.intp)
+R_IRIS_IDX = np.asarray(R_IRIS, dtype=np.intp)
+
+# 6-point EAR landmarks p1..p6, row 0 = left eye, row 1 = right eye
+EAR_IDX = np.array([[33,160,158,133,153,144],
+                    [263,387,385,362,380,373]], dtype=np.intp)
+
+def landmarks_to_pts(landmarks, w, h):
+    """All landmarks as a (N,2) float32 array in pixel coordinates."""
+    pts = np.fromiter((v for p in landmarks for v in (p.x, p.y)), dtype=np.float32,
+                      count=len(landmarks)*2).reshape(-1, 2)
+    pts[:,0] *= w; pts[:,1] *= h
+    return pts
+
+def avg_ear(pts):
+    """6-point Eye Aspect Ratio (EAR), averaged over both eyes."""
+    p = pts[EAR_IDX]  # (2,6,2)
+    d26 = np.linalg.norm(p[:,1]-p[:,5], axis=1)
+    d35 = np.linalg.norm(p[:,2]-p[:,4], axis=1)
+    d14 = np.linalg.norm(p[:,0]-p[:,3], axis=1)
+    return float(((d26 + d35) / (2.0 * d14 + 1e-6)).mean())
+
+def circle_from_pts(pts_arr):
+    """Crude circle from (4,2) iris points: center=mean, radius=mean distance."""
+    c = pts_arr.mean(0)
+    r = np.linalg.norm(pts_arr-c, axis=1).mean()
+    return c[0], c[1], max(float(r), 1.0)
+
+def redness_index(frame, pts, pad=4):
+    """Approx sclera redness: mean R/(R+G+B) over (eye ring - iris) on bright pixels.
+    All mask/float work happens inside a tight crop around both eye rings."""
     h, w = frame.shape[:2]
-    l_poly = [(landmarks[i].x*w, landmarks[i].y*h) for i in L_EYE_RING]
-    r_poly = [(landmarks[i].x*w, landmarks[i].y*h) for i in R_EYE_RING]
-    l_iris_pts = [(landmarks[i].x*w, landmarks[i].y*h) for i in L_IRIS]
-    r_iris_pts = [(landmarks[i].x*w, landmarks[i].y*h) for i in R_IRIS]
-    lcx,lcy,lr = circle_from_pts(l_iris_pts)
-    rcx,rcy,rr = circle_from_pts(r_iris_pts)
-
-    mask_l = poly_mask(h,w,l_poly); mask_r = poly_mask(h,w,r_poly)
-    iris_l = np.zeros((h,w), np.uint8); cv2.circle(iris_l,(lcx,lcy), int(lr*1.2), 255,-1)
-    iris_r = np.zeros((h,w), np.uint8); cv2.circle(iris_r,(rcx,rcy), int(rr*1.2), 255,-1)
-
-    sclera_mask = cv2.bitwise_or(mask_l, mask_r)
-    sclera_mask = cv2.bitwise_and(sclera_mask, cv2.bitwise_not(cv2.bitwise_or(iris_l, iris_r)))
-
-    b,g,r = cv2.split(frame)
-    sum_bgr = b.astype(np.float32)+g.astype(np.float32)+r.astype(np.float32)+1e-6
-    red_ratio = r.astype(np.float32)/sum_bgr
-
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    bright = cv2.threshold(gray, 80, 255, cv2.THRESH_BINARY)[1]
+    rings = pts[EYE_RINGS_IDX]
+    x0 = max(int(rings[:,0].min())-pad, 0); x1 = min(int(rings[:,0].max())+pad+1, w)
+    y0 = max(int(rings[:,1].min())-pad, 0); y1 = min(int(rings[:,1].max())+pad+1, h)
+    if x1 <= x0 or y1 <= y0:
+        return 0.0
+    roi = frame[y0:y1, x0:x1]
+    rh, rw = roi.shape[:2]
+
+    off = np.array([x0, y0], dtype=np.float32)
+    l_poly = (pts[L_EYE_RING_IDX]-off).astype(np.int32)
+    r_poly = (pts[R_EYE_RING_IDX]-off).astype(np.int32)
+    lcx,lcy,lr = circle_from_pts(pts[L_IRIS_IDX]-off)
+    rcx,rcy,rr = circle_from_pts(pts[R_IRIS_IDX]-off)
+
+    # both eye rings in one fill, then punch the irises out in place
+    sclera_mask = np.zeros((rh,rw), np.uint8)
+    cv2.fillPoly(sclera_mask, [l_poly, r_poly], 255)
+    cv2.circle(sclera_mask,(int(lcx),int(lcy)), int(lr*1.2), 0,-1)
+    cv2.circle(sclera_mask,(int(rcx),int(rcy)), int(rr*1.2), 0,-1)
+
+    bright = cv2.threshold(cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY), 80, 255, cv2.THRESH_BINARY)[1]
     valid = cv2.bitwise_and(sclera_mask, bright)
-    vals = red_ratio[valid>0]
-    if len(vals)==0: 
+    if cv2.countNonZero(valid) == 0:
         return 0.0
-    return float(np.mean(vals))
+    b,g,r = cv2.split(roi)
+    sum_bgr = cv2.add(cv2.add(b, g, dtype=cv2.CV_32F), r, dtype=cv2.CV_32F)
+    cv2.add(sum_bgr, 1e-6, dst=sum_bgr)
+    red_ratio = cv2.divide(r, sum_bgr, dtype=cv2.CV_32F)
+    return float(cv2.mean(red_ratio, mask=valid)[0])
+
+_FM = threading.local()
+
+def _get_fm(refine_landmarks):
+    """FaceMesh for a new video, cached per thread so concurrent extract_from_video
+    calls never share a graph. A cached instance is reset() before reuse, so tracking
+    never carries over from the previous video and results don't depend on call history."""
+    cache = getattr(_FM, "cache", None)
+    if cache is None:
+        cache = _FM.cache = {}
+    fm = cache.get(refine_landmarks)
+    if fm is None:
+        fm = cache[refine_landmarks] = mp_face.FaceMesh(
+            max_num_faces=1, refine_landmarks=refine_landmarks,
+            min_detection_confidence=0.5, min_tracking_confidence=0.5)
+    else:
+        fm.reset()
+    return fm
+
+def _detect_blinks(ears, idx, EAR_THRESH, MIN_SAMPLES, INCOMPLETE_CUTOFF):
+    """Blink segmentation over per-sample EARs: runs of EAR < EAR_THRESH lasting
+    MIN_SAMPLES+ samples that reopen before the end of the video.
+    Returns (blinks, incomplete, gaps) with gaps in sample-index units."""
+    d = np.diff((ears < EAR_THRESH).astype(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(d == 1)
+    ends = np.flatnonzero(d == -1)   # first sample back above threshold
+    if starts.size == 0:
+        return 0, 0, np.empty(0, np.int64)
+    # each segment spans a run plus the open-eye samples after it, so its min is the run's min
+    run_min = np.minimum.reduceat(ears, starts)
+    valid = (ends - starts >= MIN_SAMPLES) & (ends < ears.size)
+    blinks = int(valid.sum())
+    incomplete = int((run_min[valid] > INCOMPLETE_CUTOFF).sum())
+    return blinks, incomplete, np.diff(idx[ends[valid]])
 
 def analyze_video(path, EAR_THRESH=0.22, MIN_FRAMES=2, INCOMPLETE_CUTOFF=0.18,
-                  FRAME_STEP=1, MAX_SECONDS=None, PROGRESS_EVERY=300):
+                  FRAME_STEP=1, TARGET_FPS=10.0, WORK_WIDTH=640, RED_STRIDE=None,
+                  MAX_SECONDS=None, PROGRESS_EVERY=300):
     cap = cv2.VideoCapture(str(path))
     if not cap.isOpened():
         raise RuntimeError(f"Failed to open video: {path}")
 
     fps = cap.get(cv2.CAP_PROP_FPS) or 20.0
     total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    # Default is full rate, which is what the training features were extracted at.
+    # FRAME_STEP=None opts into ~TARGET_FPS sampling (skipped frames are grabbed, never
+    # decoded); that changes the blink features, so re-extract and retrain before using it.
+    # The auto step is capped, and disabled for implausible fps (MediaRecorder WebM often reports 1000).
+    if FRAME_STEP:
+        step = FRAME_STEP
+    elif fps <= 240:
+        step = min(max(1, int(round(fps / TARGET_FPS))), 6)
+    else:
+        step = 1
+    # MIN_FRAMES is in raw frames; the blink runs are counted in samples
+    min_samples = max(1, math.ceil(MIN_FRAMES / step))
+    # redness is only averaged, so ~1 sample per second is plenty
+    red_stride = RED_STRIDE or max(1, int(round(fps / step)))
 
-    frames = 0
-    blinks = 0
-    incomplete = 0
-    low = 0
-    min_ear = 1.0
-    last_blink_frame = None
-    ibis = []
-    reds = []
-
-    with mp_face.FaceMesh(max_num_faces=1, refine_landmarks=True,
-                          min_detection_confidence=0.5, min_tracking_confidence=0.5) as fm:
-        while True:
+    frames = 0      # raw frames consumed (duration)
+    processed = 0   # decoded samples (blink timing)
+    ears = array("f")   # EAR per sample with a face
+    idxs = array("q")   # matching processed index
+    red_sum = 0.0; red_n = 0
+    last_red = None     # processed index of the last redness sample
+    small = None    # reused resize target
+    rgb = None      # reused BGR->RGB target
+
+    # refine_landmarks also moves the eye contour, and EAR_THRESH/INCOMPLETE_CUTOFF were
+    # tuned on refined EARs, so one refined mesh serves both EAR and redness every sample
+    fm = _get_fm(True)
+
+    while True:
+        for _ in range(step-1):
+            if not cap.grab():
+                break
+            frames += 1
+        if not cap.grab():
+            break
+        frames += 1
+        ok, frame = cap.retrieve()
+        if not ok:
             ok, frame = cap.read()
             if not ok:
                 break
             frames += 1
+        processed += 1
+
+        # FaceMesh accuracy saturates well below 1080p; work at a fixed width
+        if WORK_WIDTH and frame.shape[1] > WORK_WIDTH:
+            if small is None:
+                fh, fw = frame.shape[:2]
+                small = np.empty((int(round(fh*WORK_WIDTH/fw)), WORK_WIDTH, 3), np.uint8)
+            frame = cv2.resize(frame, small.shape[1::-1], dst=small, interpolation=cv2.INTER_AREA)
+
+        red_due = last_red is None or processed - last_red >= red_stride
 
-            h, w = frame.shape[:2]
-            res = fm.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            if res.multi_face_landmarks:
-                lm = res.multi_face_landmarks[0].landmark
-
-                e = (ear(lm,w,h,True) + ear(lm,w,h,False))/2.0
-                if e < EAR_THRESH:
-                    low += 1
-                    min_ear = min(min_ear, e)
-                else:
-                    if low >= MIN_FRAMES:
-                        blinks += 1
-                        if min_ear > INCOMPLETE_CUTOFF:
-                            incomplete += 1
-                        if last_blink_frame is not None:
-                            ibis.append((frames - last_blink_frame)/fps)
-                        last_blink_frame = frames
-                    low = 0
-                    min_ear = 1.0
+        h, w = frame.shape[:2]
+        if rgb is None:
+            rgb = np.empty_like(frame)
+        rgb.flags.writeable = True
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb)
+        rgb.flags.writeable = False   # lets MediaPipe take the buffer by reference
+        res = fm.process(rgb)
+        if res.multi_face_landmarks:
+            pts = landmarks_to_pts(res.multi_face_landmarks[0].landmark, w, h)
+            ears.append(avg_ear(pts))
+            idxs.append(processed)
 
+            if red_due:
+                last_red = processed
                 try:
-                    reds.append(redness_index(frame, lm))
+                    red_sum += redness_index(frame, pts)
+                    red_n += 1
                 except Exception:
                     pass
 
-            if MAX_SECONDS is not None and frames / fps >= MAX_SECONDS:
-                break
-
-            for _ in range(max(1, FRAME_STEP)-1):
-                cap.grab()
-                frames += 1
+        if MAX_SECONDS is not None and frames / fps >= MAX_SECONDS:
+            break
 
     cap.release()
 
+    blinks, incomplete, gaps = _detect_blinks(
+        np.asarray(ears, dtype=np.float32), np.asarray(idxs, dtype=np.int64),
+        EAR_THRESH, min_samples, INCOMPLETE_CUTOFF)
+
     dur = frames / fps if fps else 0.0
     bpm = (blinks/dur)*60.0 if dur>0 else 0.0
     inc_ratio = (incomplete/blinks) if blinks>0 else 0.0
-    avg_ibi = float(np.mean(ibis)) if ibis else 0.0
-    avg_red = float(np.mean(reds)) if reds else 0.0
+    avg_ibi = float(gaps.mean())*step/fps if len(gaps) else 0.0
+    avg_red = red_sum/red_n if red_n else 0.0
 
     return dict(
         duration_sec=round(dur,2),
@@ -161,6 +245,21 @@ def pid_from(name):
     m = re.match(r"([^_]+)_", name)
     return m.group(1) if m else "UNKNOWN"
 
+def _init_worker():
+    # one OpenCV thread per process; the pool already uses the cores
+    cv2.setNumThreads(1)
+
+def _analyze_one(v, **params):
+    """CSV row for one video (module-level so the process pool can pickle it)."""
+    try:
+        m = analyze_video(v, **params)
+    except Exception as e:
+        print(f"[ERROR] {v.name}: {e}")
+        return None
+    return [pid_from(v.name), v.name, m["duration_sec"], m["blinks"],
+            m["blink_rate_bpm"], m["incomplete_blink_ratio"],
+            m["avg_ibi_sec"], m["redness_index"]]
+
 def main():
     EAR_THRESH        = 0.22
     MIN_FRAMES        = 2
@@ -179,22 +278,18 @@ def main():
         w = csv.writer(f)
         w.writerow(["participant_id","filename","duration_sec","blinks","blink_rate_bpm",
                     "incomplete_blink_ratio","avg_ibi_sec","redness_index"])
-        for v in videos:
-            try:
-                m = analyze_video(
-                    v,
-                    EAR_THRESH=EAR_THRESH,
-                    MIN_FRAMES=MIN_FRAMES,
-                    INCOMPLETE_CUTOFF=INCOMPLETE_CUTOFF,
-                    FRAME_STEP=FRAME_STEP,
-                    MAX_SECONDS=MAX_SECONDS,
-                    PROGRESS_EVERY=300
-                )
-                w.writerow([pid_from(v.name), v.name, m["duration_sec"], m["blinks"],
-                            m["blink_rate_bpm"], m["incomplete_blink_ratio"],
-                            m["avg_ibi_sec"], m["redness_index"]])
-            except Exception as e:
-                print(f"[ERROR] {v.name}: {e}")
+        analyze = partial(_analyze_one,
+                          EAR_THRESH=EAR_THRESH,
+                          MIN_FRAMES=MIN_FRAMES,
+                          INCOMPLETE_CUTOFF=INCOMPLETE_CUTOFF,
+                          FRAME_STEP=FRAME_STEP,
+                          MAX_SECONDS=MAX_SECONDS,
+                          PROGRESS_EVERY=300)
+        workers = max(1, min(len(videos), (os.cpu_count() or 2)//2))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as ex:
+            for row in ex.map(analyze, videos):
+                if row is not None:
+                    w.writerow(row)
     print(f"[OK] Saved {out.resolve()}")
 
 if __name__ == "__main__":
@@ -1,8 +1,10 @@
 # train_model_best.py
 # Goal: honest 75–89% accuracy (no OSDI leakage), one-shot training.
+# Requires joblib >= 1.3 (Parallel(return_as="generator")).
 
 import argparse, json, joblib, numpy as np, pandas as pd
 from typing import List, Tuple
+from joblib import Parallel, delayed
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import classification_report, confusion_matrix, accuracy_score
@@ -87,14 +89,20 @@ def main(dataset_path: str, seeds: List[int], target_low: float, target_high: fl
     best_acc = -1.0
     best = None
 
-    for s in seeds:
-        acc, res, clf, le = train_once(df, s)
-        # choose first model in band 0.75–0.89
-        if target_low <= acc <= target_high and chosen is None:
-            chosen = (acc, res, clf, le)
-        # track best overall as fallback
-        if acc > best_acc:
-            best_acc, best = acc, (acc, res, clf, le)
+    # seeds are independent fits; results stream back in seed order so we can stop early
+    results = Parallel(n_jobs=-1, backend="loky", return_as="generator")(
+        delayed(train_once)(df, s) for s in seeds)
+    try:
+        for acc, res, clf, le in results:
+            # choose first model in band 0.75–0.89
+            if target_low <= acc <= target_high:
+                chosen = (acc, res, clf, le)
+                break
+            # track best overall as fallback
+            if acc > best_acc:
+                best_acc, best = acc, (acc, res, clf, le)
+    finally:
+        results.close()  # cancel seeds still queued after an early exit
 
     acc, res, clf, le = chosen if chosen is not None else best
 